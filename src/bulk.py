@@ -0,0 +1,256 @@
+import argparse
+import hashlib
+import json
+import re
+import sqlite3
+import sys
+
+from scry import BulkData, Card, Migration
+
+
+# Scryfall starts each card with its object type and id, so we can usually
+# find the top-level id without parsing the whole card.
+id_pattern = re.compile(rb'\{"object": *"card", *"id": *"(?P<id>[0-9a-f-]+)"')
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cards (
+    id TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    name TEXT,
+    set_code TEXT,
+    collector_number TEXT,
+    lang TEXT,
+    json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cards_by_name ON cards (name);
+CREATE INDEX IF NOT EXISTS cards_by_number ON cards (set_code, collector_number);
+CREATE TABLE IF NOT EXISTS deletions (
+    id TEXT PRIMARY KEY,
+    migration TEXT NOT NULL,
+    name TEXT,
+    set_code TEXT,
+    collector_number TEXT
+);
+"""
+
+
+class Corpus:
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        (count,) = self.db.execute("SELECT COUNT(*) FROM cards").fetchone()
+        return count
+
+    def meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?)"
+            " ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+    def card(self, id):
+        row = self.db.execute("SELECT json FROM cards WHERE id = ?", (id,)).fetchone()
+        return Card(json.loads(row[0])) if row else None
+
+    def named(self, name):
+        return [
+            Card(json.loads(row[0]))
+            for row in self.db.execute("SELECT json FROM cards WHERE name = ?", (name,))
+        ]
+
+    def numbered(self, code, number):
+        return [
+            Card(json.loads(row[0]))
+            for row in self.db.execute(
+                "SELECT json FROM cards WHERE set_code = ? AND collector_number = ?",
+                (code.lower(), number),
+            )
+        ]
+
+    def merge(self, old_id, new_id):
+        if self.db.execute("SELECT 1 FROM cards WHERE id = ?", (new_id,)).fetchone():
+            self.db.execute("DELETE FROM cards WHERE id = ?", (old_id,))
+        else:
+            # Keep the card warm under its new id; the cleared digest makes the
+            # next sync replace it with whatever Scryfall now has for that id.
+            self.db.execute(
+                "UPDATE cards SET id = ?, digest = '', json = json_set(json, '$.id', ?)"
+                " WHERE id = ?",
+                (new_id, new_id, old_id),
+            )
+
+    def delete(self, id, migration_id):
+        row = self.db.execute(
+            "SELECT name, set_code, collector_number FROM cards WHERE id = ?", (id,)
+        ).fetchone()
+        self.db.execute(
+            "INSERT OR REPLACE INTO deletions"
+            " (id, migration, name, set_code, collector_number)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (id, migration_id, *(row or (None, None, None))),
+        )
+        self.db.execute("DELETE FROM cards WHERE id = ?", (id,))
+
+    def deleted(self, placeholder):
+        identifier = dict(placeholder)
+        code = identifier.get("set", "").lower() or None
+
+        if "collector_number" in identifier:
+            where = "set_code = ? AND collector_number = ?"
+            params = (code, identifier["collector_number"])
+        elif code:
+            where = "name = ? AND set_code = ?"
+            params = (identifier["name"], code)
+        else:
+            where = "name = ?"
+            params = (identifier["name"],)
+
+        # A name only goes missing if no other printing survives the deletion.
+        if self.db.execute(f"SELECT 1 FROM cards WHERE {where}", params).fetchone():
+            return []
+
+        return [
+            id
+            for (id,) in self.db.execute(
+                f"SELECT id FROM deletions WHERE {where}", params
+            )
+        ]
+
+    def sync(self, type="default_cards", force=False):
+        bulk = BulkData.from_type(type)
+
+        if (
+            not force
+            and self.meta("type") == type
+            and self.meta("updated_at") == bulk.updated_at
+        ):
+            print(f"{type} is up to date ({bulk.updated_at})", file=sys.stderr)
+            return 0, 0, 0
+
+        digests = dict(self.db.execute("SELECT id, digest FROM cards"))
+        seen = set()
+        inserted = updated = 0
+
+        with bulk.download_uri.stream() as response, self.db:
+            # An empty corpus is about to be filled with cards as they are
+            # now, so only later migrations can affect it.
+            if not digests and self.meta("migration") is None:
+                newest = Migration.newest()
+                if newest is not None:
+                    self.set_meta("migration", newest.id)
+
+            for record in Corpus._records(response.iter_lines(chunk_size=1 << 16)):
+                digest = hashlib.sha1(record).hexdigest()
+                match = id_pattern.match(record)
+                if match:
+                    id = match.group("id").decode()
+                else:
+                    id = json.loads(record)["id"]
+                seen.add(id)
+
+                # Only records that are new or changed get parsed and indexed;
+                # everything else costs no more than a hash comparison.
+                previous = digests.get(id)
+                if previous == digest:
+                    continue
+                if previous is None:
+                    inserted += 1
+                else:
+                    updated += 1
+                self._upsert(id, digest, json.loads(record))
+
+            # Cards that disappear from a snapshot of the same type have been
+            # deleted upstream, so record them for decklists to be checked
+            # against, whether or not the migration has been applied yet.
+            deleted = digests.keys() - seen
+            if self.meta("type") == type:
+                for id in deleted:
+                    self.delete(id, f"sync {bulk.updated_at}")
+            else:
+                self.db.executemany(
+                    "DELETE FROM cards WHERE id = ?", [(id,) for id in deleted]
+                )
+
+            self.set_meta("type", type)
+            self.set_meta("updated_at", bulk.updated_at)
+
+        print(
+            f"Synced {type} ({bulk.updated_at}): {inserted} inserted,"
+            f" {updated} updated, {len(deleted)} deleted",
+            file=sys.stderr,
+        )
+        return inserted, updated, len(deleted)
+
+    def _upsert(self, id, digest, card):
+        self.db.execute(
+            "INSERT INTO cards"
+            " (id, digest, name, set_code, collector_number, lang, json)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (id) DO UPDATE SET"
+            " digest = excluded.digest, name = excluded.name,"
+            " set_code = excluded.set_code,"
+            " collector_number = excluded.collector_number,"
+            " lang = excluded.lang, json = excluded.json",
+            (
+                id,
+                digest,
+                card.get("name"),
+                card.get("set"),
+                card.get("collector_number"),
+                card.get("lang"),
+                json.dumps(card),
+            ),
+        )
+
+    @staticmethod
+    def _records(lines):
+        # Scryfall writes its bulk files as a JSON array with one card per
+        # line, which lets us stream them instead of loading the whole array.
+        # Should that ever change, fall back to parsing the array in one go.
+        lines = iter(lines)
+        head = []
+        for line in lines:
+            head.append(line)
+            record = line.strip().rstrip(b",")
+            if record in (b"", b"[", b"]"):
+                continue
+            if not (record.startswith(b"{") and record.endswith(b"}")):
+                array = b"\n".join(head + list(lines))
+                for card in json.loads(array):
+                    yield json.dumps(card).encode()
+                return
+            head = []
+            yield record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync a local Scryfall bulk corpus.")
+    parser.add_argument("-d", "--database", default="bulk.sqlite3")
+    parser.add_argument("-t", "--type", default="default_cards")
+    parser.add_argument(
+        "-f", "--force", action="store_true", help="sync even if not updated"
+    )
+    args = parser.parse_args()
+
+    with Corpus(args.database) as corpus:
+        corpus.sync(args.type, args.force)
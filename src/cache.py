@@ -0,0 +1,178 @@
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+
+from scry import Card, Migration
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS identifiers (
+    placeholder TEXT PRIMARY KEY,
+    card_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS identifiers_by_card ON identifiers (card_id);
+CREATE TABLE IF NOT EXISTS cards (
+    id TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    json TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deletions (
+    placeholder TEXT PRIMARY KEY,
+    card_id TEXT NOT NULL,
+    migration TEXT NOT NULL
+);
+"""
+
+
+class Cache:
+    # Remembers which card each placeholder resolved to, which hardly ever
+    # changes, separately from the card data itself, which goes stale after
+    # max_age seconds and is then refreshed by id.
+    def __init__(self, path, max_age=7 * 24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        # Several processes on the same host may share the cache, so wait for
+        # their writes to finish rather than failing on a locked database.
+        # SQLite's locking can't be relied upon over network filesystems, so
+        # separate machines must each use a cache of their own.
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.executescript(schema)
+        self._lock = threading.RLock()
+        self._seeded = False
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self.db.execute("SELECT COUNT(*) FROM identifiers").fetchone()
+        return count
+
+    def meta(self, key, default=None):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+    def lookup(self, placeholders):
+        fresh = {}
+        stale = {}
+        cutoff = time.time() - self.max_age
+
+        with self._lock:
+            for placeholder in placeholders:
+                row = self.db.execute(
+                    "SELECT identifiers.card_id, cards.fetched_at, cards.json"
+                    " FROM identifiers LEFT JOIN cards"
+                    " ON cards.id = identifiers.card_id"
+                    " WHERE identifiers.placeholder = ?",
+                    (Cache._key(placeholder),),
+                ).fetchone()
+                if row is None:
+                    continue
+                card_id, fetched_at, card_json = row
+                if card_json is not None and fetched_at >= cutoff:
+                    fresh[placeholder] = Card(json.loads(card_json))
+                else:
+                    stale[placeholder] = card_id
+
+        return fresh, stale
+
+    def store(self, collection):
+        self._seed_migration()
+
+        now = time.time()
+
+        with self._lock, self.db:
+            for placeholder, card in collection.items():
+                key = Cache._key(placeholder)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO identifiers (placeholder, card_id)"
+                    " VALUES (?, ?)",
+                    (key, card.id),
+                )
+                self.db.execute(
+                    "INSERT OR REPLACE INTO cards (id, fetched_at, json)"
+                    " VALUES (?, ?, ?)",
+                    (card.id, now, json.dumps(card._json)),
+                )
+                self.db.execute("DELETE FROM deletions WHERE placeholder = ?", (key,))
+
+    def merge(self, old_id, new_id):
+        with self._lock:
+            self.db.execute(
+                "UPDATE identifiers SET card_id = ? WHERE card_id = ?",
+                (new_id, old_id),
+            )
+            # Whatever we had for the old id is only a stand-in for the new
+            # card, so mark it stale to have it refreshed on next use.
+            self.db.execute(
+                "INSERT OR IGNORE INTO cards (id, fetched_at, json)"
+                " SELECT ?, 0, json_set(json, '$.id', ?) FROM cards WHERE id = ?",
+                (new_id, new_id, old_id),
+            )
+            self.db.execute("DELETE FROM cards WHERE id = ?", (old_id,))
+
+    def delete(self, id, migration_id):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO deletions (placeholder, card_id, migration)"
+                " SELECT placeholder, card_id, ? FROM identifiers WHERE card_id = ?",
+                (migration_id, id),
+            )
+            self.db.execute("DELETE FROM identifiers WHERE card_id = ?", (id,))
+            self.db.execute("DELETE FROM cards WHERE id = ?", (id,))
+
+    def deleted(self, placeholder):
+        with self._lock:
+            return [
+                card_id
+                for (card_id,) in self.db.execute(
+                    "SELECT card_id FROM deletions WHERE placeholder = ?",
+                    (Cache._key(placeholder),),
+                )
+            ]
+
+    def _seed_migration(self):
+        # An empty cache is about to be filled with cards as they are now, so
+        # only later migrations can affect it.
+        if self._seeded:
+            return
+        with self._lock:
+            if self.meta("migration") is None and len(self) == 0:
+                # Not worth failing a build over; without a marker, migrate.py
+                # just replays the whole history instead.
+                try:
+                    newest = Migration.newest()
+                except requests.RequestException:
+                    return
+                if newest is not None:
+                    with self.db:
+                        self.set_meta("migration", newest.id)
+            self._seeded = True
+
+    @staticmethod
+    def _key(placeholder):
+        return json.dumps(placeholder)
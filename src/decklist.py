@@ -1,8 +1,15 @@
+import argparse
 import os
+import queue
 import re
 import sys
+import threading
 from typing import Any
 
+import requests
+
+import shard
+from cache import Cache
 from environment import environment
 from scry import Card, Set
 
@@ -25,6 +32,7 @@ card_pattern = re.compile(
 template = environment.get_template("decklist.html")
 
 set_symbols: dict[str, Set] = {}
+set_symbols_lock = threading.Lock()
 
 Placeholder = tuple[tuple[str, Any], ...]
 
@@ -34,73 +42,193 @@ def frozendict(d):
 
 
 def parse_decklist(deck_path, placeholders):
+    with open(deck_path, encoding="utf-8") as deck_file:
+        return parse_lines(deck_file, placeholders)
+
+
+def parse_lines(lines, placeholders):
     title = None
     sections = []
     section = None
 
-    with open(deck_path, encoding="utf-8") as deck_file:
-        for line in map(str.strip, deck_file):
-            if not line:
-                section = None
-                continue
+    for line in map(str.strip, lines):
+        if not line:
+            section = None
+            continue
 
-            if not title:
-                title = line
-                continue
+        if not title:
+            title = line
+            continue
 
-            if not section:
-                section = Section(line)
-                sections.append(section)
-                continue
+        if not section:
+            section = Section(line)
+            sections.append(section)
+            continue
 
-            match = card_pattern.fullmatch(line)
-            if not match:
-                raise Exception(f"Failed to parse line: {line!r}")
+        match = card_pattern.fullmatch(line)
+        if not match:
+            raise Exception(f"Failed to parse line: {line!r}")
 
-            name, code, number = match.group("name", "code", "number")
-            count_str = match.group("count")
-            count = int(count_str) if count_str else 0
+        name, code, number = match.group("name", "code", "number")
+        count_str = match.group("count")
+        count = int(count_str) if count_str else 0
 
-            identifier = {}
+        identifier = {}
 
-            if number:
-                identifier["collector_number"] = number
-            else:
-                # /cards/collection apparently can't identify split cards by
-                # their full name (e.g. Fire // Ice), so instead we use only
-                # their first name (e.g. Fire), which is still unique.
-                identifier["name"] = name.split("//")[0].strip()
+        if number:
+            identifier["collector_number"] = number
+        else:
+            # /cards/collection apparently can't identify split cards by
+            # their full name (e.g. Fire // Ice), so instead we use only
+            # their first name (e.g. Fire), which is still unique.
+            identifier["name"] = name.split("//")[0].strip()
 
-            if code:
-                identifier["set"] = code
+        if code:
+            identifier["set"] = code
 
-            # Leave identifier as a placeholder that we later use to obtain the card.
-            placeholder = frozendict(identifier)
-            section.cards[placeholder] = count
-            placeholders.add(placeholder)
+        # Leave identifier as a placeholder that we later use to obtain the card.
+        placeholder = frozendict(identifier)
+        section.cards[placeholder] = count
+        placeholders.add(placeholder)
 
     return title, sections
 
 
-def fetch_collection(placeholders):
-    identifiers = list(map(dict, placeholders))
+def fetch_collection(placeholders, failures=None, cache=None):
+    if cache is not None:
+        return cached_collection(placeholders, cache, failures)
+
+    placeholders = list(placeholders)
+
+    # An empty collection request is an error, and there's nothing to ask.
+    if not placeholders:
+        return {}
+
+    if failures is None:
+        identifiers = list(map(dict, placeholders))
+        cards = Card.collection(identifiers)
+        return dict(zip(placeholders, cards))
+
+    # Resolve page by page, so that one failed request or an unknown card only
+    # loses the placeholders concerned, which are recorded in failures instead.
+    collection = {}
+    limit = Card.collection_limit
+    for start in range(0, len(placeholders), limit):
+        page = placeholders[start : start + limit]
+        try:
+            result = Card.collection(list(map(dict, page)), strict=False)
+        except requests.RequestException as e:
+            failures.update(dict.fromkeys(page, str(e)))
+            continue
+        cards = iter(result.data)
+        for placeholder in page:
+            if dict(placeholder) in result.not_found:
+                failures[placeholder] = "not found"
+            else:
+                collection[placeholder] = next(cards)
+
+    return collection
+
+
+def cached_collection(placeholders, cache, failures=None):
+    collection, stale = cache.lookup(placeholders)
+
+    # Stale cards are refreshed by id, since we already know which card each
+    # placeholder stands for. Any that no longer resolve, say after a
+    # migration, get resolved afresh from their placeholder below instead.
+    ids: dict[Placeholder, list[Placeholder]] = {}
+    for placeholder, card_id in stale.items():
+        ids.setdefault(frozendict({"id": card_id}), []).append(placeholder)
+
+    fetched = {}
+    if ids:
+        for id_placeholder, card in fetch_collection(ids, {}).items():
+            fetched.update(dict.fromkeys(ids[id_placeholder], card))
 
-    cards = Card.collection(identifiers)
+    unknown = [p for p in placeholders if p not in collection and p not in fetched]
+    if unknown:
+        fetched.update(fetch_collection(unknown, failures))
 
-    return dict(zip(placeholders, cards))
+    cache.store(fetched)
+    collection.update(fetched)
+
+    return collection
+
+
+def format_placeholder(placeholder):
+    identifier = dict(placeholder)
+    if "name" in identifier:
+        text = identifier["name"]
+        if "set" in identifier:
+            text += f" ({identifier['set']})"
+    else:
+        text = f"({identifier['set']}) {identifier['collector_number']}"
+    return text
+
+
+def set_symbol(code):
+    global set_symbols
+    code = code.lower()
+    if code not in set_symbols:
+        # Pipeline stages may miss at the same time; only one of them needs
+        # to fetch the set list.
+        with set_symbols_lock:
+            if code not in set_symbols:
+                set_symbols = {symbol.code: symbol for symbol in Set.list()}
+    if code not in set_symbols:
+        raise Exception(f"Unknown set code {code.upper()!r}")
+    return set_symbols[code]
+
+
+def missing_cards(path, decklist, collection, failures):
+    _, sections = decklist
+    missing = [
+        placeholder
+        for section in sections
+        for placeholder in section.cards
+        if placeholder not in collection
+    ]
+    for placeholder in missing:
+        print(
+            f"Error: {path}: {format_placeholder(placeholder)}:"
+            f" {failures[placeholder]}",
+            file=sys.stderr,
+        )
+    return bool(missing)
+
+
+def store_assets(decklist, collection):
+    title, _ = decklist
+    match = title_pattern.fullmatch(title)
+    if match:
+        set_symbol(match.group("code")).icon_svg()
+    for card in collection.values():
+        for symbol in getattr(card.front, "mana", ()):
+            symbol.svg()
 
 
 def pluralize(word):
     return f"{word[:-1]}ies" if word[-1] == "y" else f"{word}s"
 
 
-def generate_html(deck_path, decklist, collection):
-    title, sections = decklist
-
+def html_path_for(deck_path):
     deck_path_stem, _ = os.path.splitext(os.path.basename(deck_path))
-    html_path = f"{deck_path_stem}.html"
+    return f"{deck_path_stem}.html"
+
+
+def generate_html(deck_path, decklist, collection):
+    html_path = html_path_for(deck_path)
     print(f"Generating {html_path}")
 
+    html = render_html(deck_path, decklist, collection)
+
+    with open(html_path, "w", encoding="utf-8") as html_file:
+        html_file.write(html)
+
+
+def render_html(deck_path, decklist, collection):
+    title, sections = decklist
+
     for section in sections:
         section.cards = {
             collection[placeholder]: count
@@ -192,30 +320,214 @@ def generate_html(deck_path, decklist, collection):
 
     if match:
         deck = match.group("deck")
-        code = match.group("code").lower()
-        global set_symbols
-        if code not in set_symbols:
-            set_symbols = {symbol.code: symbol for symbol in Set.list()}
-        symbol = set_symbols[code]
+        symbol = set_symbol(match.group("code"))
     else:
         deck = title
         symbol = None
 
-    html = template.render(title=title, deck=deck, set=symbol, sections=sections)
-
-    with open(html_path, "w", encoding="utf-8") as html_file:
-        html_file.write(html)
+    return template.render(title=title, deck=deck, set=symbol, sections=sections)
 
 
-if __name__ == "__main__":
+def build(paths, keep_going=False, cache=None):
     decklists = {}
     placeholders: set[Placeholder] = set()
 
-    for path in sys.argv[1:]:
+    for path in paths:
         decklist = parse_decklist(path, placeholders)
         decklists[path] = decklist
 
-    collection = fetch_collection(placeholders)
+    failures: dict[Placeholder, str] | None = {} if keep_going else None
+
+    collection = fetch_collection(placeholders, failures, cache)
+
+    failed = []
 
     for path, decklist in decklists.items():
-        generate_html(path, decklist, collection)
+        if missing_cards(path, decklist, collection, failures):
+            failed.append(path)
+            continue
+        try:
+            generate_html(path, decklist, collection)
+        except Exception as e:
+            if not keep_going:
+                raise
+            print(f"Error: {path}: {e}", file=sys.stderr)
+            failed.append(path)
+
+    if failed:
+        print(
+            f"Failed to generate {len(failed)} of {len(decklists)} decklists",
+            file=sys.stderr,
+        )
+
+    return failed
+
+
+def build_pipeline(paths, keep_going=False, cache=None, queue_size=8):
+    # Parsing, resolving, storing assets and rendering each run in their own
+    # stage, connected by bounded queues, so that each deck is written as soon
+    # as its own cards are resolved and only a few decks are in flight.
+    parsed: queue.Queue = queue.Queue(queue_size)
+    resolved: queue.Queue = queue.Queue(queue_size)
+    stored: queue.Queue = queue.Queue(queue_size)
+    done = object()
+    errors = []
+
+    def stage(target, output):
+        def run():
+            try:
+                target()
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                output.put(done)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+    def parse():
+        for path in paths:
+            placeholders: set[Placeholder] = set()
+            decklist = parse_decklist(path, placeholders)
+            parsed.put((path, decklist, placeholders))
+
+    def resolve():
+        # Cards shared between decks are only ever resolved once.
+        collection: dict[Placeholder, Card] = {}
+        failures: dict[Placeholder, str] = {}
+        unresolved: set[Placeholder] = set()
+        waiting = []
+        finished = False
+
+        while waiting or not finished:
+            # Take in decks until there is a full batch to resolve, or until
+            # there are no more decks ready and there's some work to do.
+            while not finished and len(unresolved) < Card.collection_limit:
+                try:
+                    item = parsed.get(block=not waiting)
+                except queue.Empty:
+                    break
+                if item is done:
+                    finished = True
+                    break
+                waiting.append(item)
+                _, _, placeholders = item
+                unresolved |= placeholders - collection.keys() - failures.keys()
+
+            batch = list(unresolved)[: Card.collection_limit]
+            if batch:
+                unresolved.difference_update(batch)
+                collection.update(
+                    fetch_collection(batch, failures if keep_going else None, cache)
+                )
+
+            still_waiting = []
+            for item in waiting:
+                path, decklist, placeholders = item
+                if placeholders & unresolved:
+                    still_waiting.append(item)
+                    continue
+                cards = {p: collection[p] for p in placeholders if p in collection}
+                missing = {p: failures[p] for p in placeholders if p in failures}
+                resolved.put((path, decklist, cards, missing, None))
+            waiting = still_waiting
+
+    def store():
+        while (item := resolved.get()) is not done:
+            path, decklist, cards, missing, _ = item
+            try:
+                store_assets(decklist, cards)
+            except Exception as e:
+                # Leave it to the render loop to report, in order with the rest.
+                if not keep_going:
+                    raise
+                item = path, decklist, cards, missing, e
+            stored.put(item)
+
+    stage(parse, parsed)
+    stage(resolve, resolved)
+    stage(store, stored)
+
+    total = 0
+    failed = []
+
+    while (item := stored.get()) is not done:
+        path, decklist, cards, missing, error = item
+        total += 1
+        if missing_cards(path, decklist, cards, missing):
+            failed.append(path)
+            continue
+        try:
+            if error is not None:
+                raise error
+            generate_html(path, decklist, cards)
+        except Exception as e:
+            if not keep_going:
+                raise
+            print(f"Error: {path}: {e}", file=sys.stderr)
+            failed.append(path)
+
+    if errors:
+        raise errors[0]
+
+    if failed:
+        print(
+            f"Failed to generate {len(failed)} of {total} decklists",
+            file=sys.stderr,
+        )
+
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate HTML decklists.")
+    parser.add_argument("decklists", nargs="+", metavar="DECKLIST")
+    parser.add_argument(
+        "-k",
+        "--keep-going",
+        action="store_true",
+        help="render every decklist whose cards resolve, reporting the rest",
+    )
+    parser.add_argument(
+        "-p",
+        "--pipeline",
+        action="store_true",
+        help="write each decklist as soon as its cards are resolved",
+    )
+    parser.add_argument("-c", "--cache", help="card cache to resolve through")
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=7,
+        metavar="DAYS",
+        help="refresh cached cards older than this (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-s",
+        "--shard",
+        type=shard.parse_shard,
+        metavar="K/N",
+        help="only build the K-th of N shards of the decklists, writing a manifest;"
+        " shards on one host may share a cache, but not across machines",
+    )
+    args = parser.parse_args()
+
+    paths = args.decklists
+    if args.shard:
+        paths = shard.select(paths, *args.shard)
+
+    cache = Cache(args.cache, args.max_age * 24 * 60 * 60) if args.cache else None
+
+    if args.pipeline:
+        failed = build_pipeline(paths, args.keep_going, cache)
+    else:
+        failed = build(paths, args.keep_going, cache)
+
+    if cache:
+        cache.close()
+
+    if args.shard:
+        outputs = {path: html_path_for(path) for path in paths if path not in failed}
+        shard.write_manifest(*args.shard, paths, outputs)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,115 @@
+import argparse
+import sys
+
+from bulk import Corpus
+from cache import Cache
+from decklist import format_placeholder, parse_decklist
+from scry import Migration
+
+
+def pending_migrations(last_id):
+    # Scryfall lists migrations newest first, so we only need to page until
+    # we reach the last one we processed.
+    pending = []
+    for migration in Migration.list():
+        if migration.id == last_id:
+            break
+        pending.append(migration)
+    pending.reverse()
+    return pending
+
+
+def migrate(store):
+    last_id = store.meta("migration")
+
+    # Stores record the newest migration when they are first filled, so an
+    # empty one can simply start from there. One that was filled without a
+    # marker has to have Scryfall's whole history applied to it.
+    if last_id is None and len(store) == 0:
+        newest = Migration.newest()
+        if newest is not None:
+            with store.db:
+                store.set_meta("migration", newest.id)
+            print(
+                f"Starting {store.path} from migration {newest.id}",
+                file=sys.stderr,
+            )
+        return []
+
+    pending = pending_migrations(last_id)
+
+    merged = deleted = 0
+
+    for migration in pending:
+        # Commit each migration along with the marker, so that an interrupted
+        # run picks up exactly where it left off.
+        with store.db:
+            if migration.migration_strategy == "merge":
+                store.merge(migration.old_scryfall_id, migration.new_scryfall_id)
+                merged += 1
+            elif migration.migration_strategy == "delete":
+                store.delete(migration.old_scryfall_id, migration.id)
+                deleted += 1
+            else:
+                print(
+                    f"Warning: unknown migration strategy"
+                    f" {migration.migration_strategy!r} in {migration.id}",
+                    file=sys.stderr,
+                )
+            store.set_meta("migration", migration.id)
+
+    print(
+        f"Applied {len(pending)} migrations to {store.path}:"
+        f" {merged} merged, {deleted} deleted",
+        file=sys.stderr,
+    )
+    return pending
+
+
+def check(stores, paths):
+    flagged = []
+
+    for path in paths:
+        placeholders = set()
+        parse_decklist(path, placeholders)
+
+        for placeholder in placeholders:
+            ids = sorted({id for store in stores for id in store.deleted(placeholder)})
+            if ids:
+                if path not in flagged:
+                    flagged.append(path)
+                print(
+                    f"Warning: {path}: {format_placeholder(placeholder)}"
+                    f" refers to deleted card {', '.join(ids)}",
+                    file=sys.stderr,
+                )
+
+    return flagged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Apply Scryfall migrations to the local corpus and cache."
+    )
+    parser.add_argument("decklists", nargs="*", metavar="DECKLIST")
+    parser.add_argument("-d", "--database", help="bulk corpus to migrate")
+    parser.add_argument("-c", "--cache", help="card cache to migrate")
+    args = parser.parse_args()
+
+    if not args.database and not args.cache:
+        parser.error("nothing to migrate, give --database and/or --cache")
+
+    stores = []
+    if args.database:
+        stores.append(Corpus(args.database))
+    if args.cache:
+        stores.append(Cache(args.cache))
+
+    for store in stores:
+        migrate(store)
+    flagged = check(stores, args.decklists)
+
+    for store in stores:
+        store.close()
+
+    sys.exit(1 if flagged else 0)
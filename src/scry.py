@@ -1,18 +1,82 @@
 from __future__ import annotations
 
+import email.utils
+import json
 import math
 import os
+import random
 import re
 import requests
 import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timezone
 from functools import total_ordering
 from typing import ClassVar
 
 
+class Throttle:
+    # Paces requests to the API, slowing down whenever Scryfall pushes back
+    # and recovering gradually as requests succeed again. After too many
+    # consecutive failures the circuit opens and all requests wait out a
+    # cooldown before trying again.
+    def __init__(
+        self,
+        interval=0.1,
+        max_interval=5.0,
+        recovery=0.9,
+        threshold=5,
+        cooldown=30.0,
+    ):
+        self.min_interval = interval
+        self.interval = interval
+        self.max_interval = max_interval
+        self.recovery = recovery
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._open_until = 0.0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_at, self._open_until)
+            self._next_at = start + self.interval
+        time.sleep(start - now)
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.interval = max(self.min_interval, self.interval * self.recovery)
+
+    def pushed_back(self, retry_after=0.0):
+        with self._lock:
+            self.failures += 1
+            self.interval = min(self.max_interval, self.interval * 2)
+            pause = retry_after
+            if self.failures >= self.threshold:
+                print(
+                    f"Circuit open after {self.failures} failures,"
+                    f" pausing for {self.cooldown}s",
+                    file=sys.stderr,
+                )
+                pause = max(pause, self.cooldown)
+            self._open_until = max(self._open_until, time.monotonic() + pause)
+
+
 class Scry:
     API = "https://api.scryfall.com"
 
+    retries = 5
+    backoff = 0.5
+    max_backoff = 60.0
+    retry_statuses = frozenset({429, 500, 502, 503, 504})
+    throttle = Throttle()
+
     def __init__(self, uri):
         self.uri = Scry.API + uri if uri.startswith("/") else uri
 
@@ -23,25 +87,196 @@ class Scry:
         return f"Scry({self.uri!r})"
 
     def get(self, **kwargs):
-        if self.uri.startswith(Scry.API):
-            time.sleep(0.1)
-        response = requests.get(self.uri, params=kwargs)
-        print(f"GET {response.url}", file=sys.stderr)
-        response.raise_for_status()  # raise if not 200 OK
-        return response
+        return self._request("GET", params=kwargs)
 
     def post(self, **kwargs):
-        if self.uri.startswith(Scry.API):
-            time.sleep(0.1)
-        response = requests.post(self.uri, json=kwargs)
-        print(f"POST {response.url}", file=sys.stderr)
-        response.raise_for_status()  # raise if not 200 OK
-        return response
+        return self._request("POST", json=kwargs)
+
+    def stream(self, **kwargs):
+        return self._request("GET", params=kwargs, stream=True)
+
+    def _request(self, method, **kwargs):
+        api = self.uri.startswith(Scry.API)
+        attempt = 0
+        while True:
+            if api:
+                Scry.throttle.wait()
+            try:
+                response = requests.request(method, self.uri, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= Scry.retries:
+                    raise
+                reason = type(e).__name__
+                retry_after = 0.0
+            else:
+                print(f"{method} {response.url}", file=sys.stderr)
+                if (
+                    response.status_code not in Scry.retry_statuses
+                    or attempt >= Scry.retries
+                ):
+                    if api and response.ok:
+                        Scry.throttle.succeeded()
+                    response.raise_for_status()  # raise if not 200 OK
+                    return response
+                reason = f"{response.status_code} {response.reason}"
+                retry_after = Scry._retry_after(response)
+
+            if api:
+                Scry.throttle.pushed_back(retry_after)
+            delay = max(retry_after, Scry._backoff(attempt))
+            print(
+                f"{method} {self.uri} failed ({reason}), retrying in {delay:.1f}s",
+                file=sys.stderr,
+            )
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def _backoff(attempt):
+        # Full jitter: sleep a random fraction of the exponential ceiling, so
+        # that concurrent clients don't retry in lockstep.
+        return random.uniform(0, min(Scry.max_backoff, Scry.backoff * 2**attempt))
+
+    @staticmethod
+    def _retry_after(response):
+        value = response.headers.get("Retry-After")
+        if not value:
+            return 0.0
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return 0.0
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class ObjectCache:
+    # Keeps the JSON of recent responses, least recently used first, within a
+    # budget of max_bytes of response bodies. Each entry expires after the TTL
+    # of the longest matching endpoint prefix, where a TTL of 0 means never
+    # cached. Collections aren't cached, as the persistent card cache relies
+    # on them to refresh stale cards from Scryfall itself.
+    #
+    # Concurrent identical requests share a single one in flight. Cached JSON
+    # is shared between the objects built from it, so it must never be
+    # modified.
+    TTLS = {
+        "": 60 * 60,
+        "/bulk-data": 0,
+        "/cards/autocomplete": 0,
+        "/cards/collection": 0,
+        "/cards/random": 0,
+        "/cards/search": 10 * 60,
+        "/catalog/": 24 * 60 * 60,
+        "/migrations": 0,
+        "/sets": 24 * 60 * 60,
+        "/symbology": 24 * 60 * 60,
+    }
+
+    def __init__(self, max_bytes=64 << 20, ttls=None):
+        self.max_bytes = max_bytes
+        self.ttls = dict(ObjectCache.TTLS if ttls is None else ttls)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl(self, uri):
+        path = uri[len(Scry.API) :] if uri.startswith(Scry.API) else uri
+        prefix = max(filter(path.startswith, self.ttls), key=len, default=None)
+        return 0 if prefix is None else self.ttls[prefix]
+
+    def fetch(self, method, uri, kwargs, request):
+        key = (method, uri, json.dumps(kwargs, sort_keys=True, default=str))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, size, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+                self.expirations += 1
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            response = request()
+            value = response.json()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            ttl = self.ttl(uri)
+            size = len(response.content)
+            if ttl > 0 and size <= self.max_bytes:
+                if key in self._entries:
+                    self._remove(key)
+                self._entries[key] = (time.monotonic() + ttl, size, value)
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+
+        future.set_result(value)
+        return value
+
+    def invalidate(self, prefix=""):
+        uri_prefix = Scry(prefix).uri if prefix else ""
+        with self._lock:
+            for key in [key for key in self._entries if key[1].startswith(uri_prefix)]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
 
 
 class Object:
     _subclasses: ClassVar[dict[str, type[Object]]] = {}
 
+    cache: ClassVar[ObjectCache | None] = ObjectCache()
+
     def __init_subclass__(cls, /, object, **kwargs):
         super().__init_subclass__(**kwargs)
         Object._subclasses[object] = cls
@@ -68,11 +303,21 @@ class Object:
 
     @staticmethod
     def get(uri, **kwargs):
-        return Object(Scry(uri).get(**kwargs).json())
+        return Object._request("GET", uri, kwargs)
 
     @staticmethod
     def post(uri, **kwargs):
-        return Object(Scry(uri).post(**kwargs).json())
+        return Object._request("POST", uri, kwargs)
+
+    @staticmethod
+    def _request(method, uri, kwargs):
+        scry = Scry(uri)
+        request = scry.get if method == "GET" else scry.post
+        if Object.cache is None:
+            return Object(request(**kwargs).json())
+        return Object(
+            Object.cache.fetch(method, scry.uri, kwargs, lambda: request(**kwargs))
+        )
 
     @staticmethod
     def _map(json):
@@ -99,14 +344,17 @@ class Object:
         if query_pos >= 0:
             path = path[:query_pos]
 
-        if not os.path.exists("img"):
-            os.mkdir("img")
+        os.makedirs("img", exist_ok=True)
 
         if not os.path.exists(path):
             image_data = uri.get().content
 
-            with open(path, "wb") as image_file:
+            # Builds may share img/, so write the image under a name of our
+            # own and move it into place, which never exposes a partial file.
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(temp_path, "wb") as image_file:
                 image_file.write(image_data)
+            os.replace(temp_path, path)
 
         return path
 
@@ -136,7 +384,12 @@ class List(Object, object="list"):
             except StopIteration as e:
                 if not self._page.has_more:
                     raise e
-                self._page = self._page.next_page()
+                next_page = self._page.next_page
+                # Real lists give the next page as a URI, whereas collections
+                # stitch on a function that fetches it.
+                self._page = (
+                    next_page() if callable(next_page) else Object.get(next_page)
+                )
                 self._iter = iter(self._page.data)
                 return next(self)
 
@@ -247,20 +500,23 @@ class Card(Object, object="card"):
     def random(q=None, **kwargs):
         return Object.get("/cards/random", q=q, **kwargs)
 
+    collection_limit = 75
+
     @staticmethod
-    def collection(identifiers, **kwargs):
-        card_limit = 75
-        this_page = identifiers[:card_limit]
-        next_page = identifiers[card_limit:]
+    def collection(identifiers, strict=True, **kwargs):
+        this_page = identifiers[: Card.collection_limit]
+        next_page = identifiers[Card.collection_limit :]
         collection = Object.post("/cards/collection", identifiers=this_page, **kwargs)
         # Collections aren't quite like normal lists, as they lack 'has_next'
         # and hence 'next_page', so we stitch our own onto the returned object.
-        if collection.not_found:
+        # When not strict, the caller is expected to check each page's
+        # 'not_found' itself, as the cards in 'data' skip over those.
+        if collection.not_found and strict:
             raise Exception(f"Not found: {collection.not_found}")
         has_more = bool(next_page)
         collection.has_more = has_more
         if has_more:
-            collection.next_page = lambda: Card.collection(next_page, **kwargs)
+            collection.next_page = lambda: Card.collection(next_page, strict, **kwargs)
         return collection
 
     @staticmethod
@@ -477,6 +733,11 @@ class Catalog(Object, object="catalog"):
 
 
 class BulkData(Object, object="bulk_data"):
+    def __init__(self, json):
+        super().__init__(json)
+        if "download_uri" in json:
+            self.download_uri = Scry(json["download_uri"])
+
     @staticmethod
     def list(**kwargs):
         return Object.get("/bulk-data", **kwargs)
@@ -498,3 +759,8 @@ class Migration(Object, object="migration"):
     @staticmethod
     def from_id(id, **kwargs):
         return Object.get(f"/migrations/{id}", **kwargs)
+
+    @staticmethod
+    def newest(**kwargs):
+        # Migrations are listed newest first, so only the first page is needed.
+        return next(iter(Migration.list(**kwargs)), None)
@@ -0,0 +1,264 @@
+import argparse
+import http.server
+import json
+import mimetypes
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import decklist
+from cache import Cache
+from decklist import (
+    fetch_collection,
+    format_placeholder,
+    parse_lines,
+    render_html,
+    title_pattern,
+)
+from scry import Mana, Object, ObjectCache, Scry, Set
+
+
+sets_loaded_at = 0.0
+
+
+class Resolver:
+    # Resolves placeholders on behalf of concurrent requests. Lookups that
+    # arrive within the same window are coalesced into shared collection
+    # batches. Without a cache, resolved cards are kept for the lifetime of
+    # the service; with one, the cache alone keeps them, so that its max age
+    # applies here just as it does to builds.
+    def __init__(self, window=0.05, cache=None):
+        self.window = window
+        self.cache = cache
+        self.cards = {}
+        self._pending = {}
+        self._queue = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def resolve(self, placeholders):
+        futures = {}
+
+        with self._lock:
+            for placeholder in placeholders:
+                if placeholder in self.cards:
+                    continue
+                future = self._pending.get(placeholder)
+                if future is None:
+                    future = self._pending[placeholder] = Future()
+                    self._queue.append(placeholder)
+                futures[placeholder] = future
+            if self._queue:
+                self._wakeup.notify()
+
+        collection = {
+            placeholder: self.cards[placeholder]
+            for placeholder in placeholders
+            if placeholder not in futures
+        }
+        failures = {}
+
+        for placeholder, future in futures.items():
+            try:
+                collection[placeholder] = future.result()
+            except Exception as e:
+                failures[placeholder] = str(e)
+
+        return collection, failures
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._wakeup.wait()
+
+            # Give concurrent requests a moment to add their lookups.
+            time.sleep(self.window)
+
+            with self._lock:
+                batch, self._queue = self._queue, []
+
+            failures = {}
+            try:
+                collection = fetch_collection(batch, failures, self.cache)
+            except Exception as e:
+                collection = {}
+                failures = dict.fromkeys(batch, str(e))
+
+            with self._lock:
+                if self.cache is None:
+                    self.cards.update(collection)
+                futures = [self._pending.pop(placeholder) for placeholder in batch]
+
+            # Failures aren't kept, so that the next request tries them afresh.
+            for placeholder, future in zip(batch, futures):
+                if placeholder in collection:
+                    future.set_result(collection[placeholder])
+                else:
+                    future.set_exception(LookupError(failures[placeholder]))
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    resolver: Resolver
+    static = {"/style.css": "templates/style.css"}
+
+    def do_GET(self):
+        if self.path == "/stats" and Object.cache is not None:
+            body = json.dumps(Object.cache.stats(), indent=2).encode()
+            self._send(200, "application/json", body)
+            return
+
+        path = self.static.get(self.path)
+        if path is None and self.path.startswith("/img/"):
+            path = f"img/{os.path.basename(self.path)}"
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, "rb") as static_file:
+            body = static_file.read()
+
+        content_type, _ = mimetypes.guess_type(path)
+        self._send(200, content_type or "application/octet-stream", body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        placeholders = set()
+        try:
+            text = body.decode("utf-8")
+            deck = parse_lines(text.splitlines(), placeholders)
+        except Exception as e:
+            self._send(400, "text/plain; charset=utf-8", f"{e}\n".encode())
+            return
+
+        title, _ = deck
+        if title is None:
+            self._send(400, "text/plain; charset=utf-8", b"Empty decklist\n")
+            return
+
+        match = title_pattern.fullmatch(title)
+        if match and not known_set(match.group("code")):
+            body = f"Unknown set code {match.group('code')!r}\n".encode()
+            self._send(422, "text/plain; charset=utf-8", body)
+            return
+
+        collection, failures = self.resolver.resolve(placeholders)
+
+        if failures:
+            body = "".join(
+                f"{format_placeholder(placeholder)}: {reason}\n"
+                for placeholder, reason in failures.items()
+            )
+            self._send(422, "text/plain; charset=utf-8", body.encode())
+            return
+
+        try:
+            html = render_html(self.path, deck, collection)
+        except Exception as e:
+            # Problems with the decklist itself are raised as plain Exception;
+            # anything else is a bug of ours.
+            if type(e) is Exception:
+                self._send(422, "text/plain; charset=utf-8", f"{e}\n".encode())
+            else:
+                self.log_error("Failed to render %s: %r", self.path, e)
+                self._send(500, "text/plain; charset=utf-8", b"Internal error\n")
+            return
+
+        self._send(200, "text/html; charset=utf-8", html.encode())
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def warm():
+    # Load what every render needs up front, rather than on a first request
+    # that would otherwise race other requests to do so.
+    load_sets()
+    Mana("")
+
+
+def load_sets():
+    global sets_loaded_at
+    if Object.cache is not None:
+        Object.cache.invalidate("/sets")
+    decklist.set_symbols = {symbol.code: symbol for symbol in Set.list()}
+    sets_loaded_at = time.monotonic()
+
+
+def sets_ttl():
+    if Object.cache is None:
+        return ObjectCache.TTLS["/sets"]
+    return Object.cache.ttl(Scry("/sets").uri)
+
+
+def known_set(code):
+    # New sets are picked up by reloading the set list on a miss, but no more
+    # often than its TTL, so that bad codes can't have us fetch it each time.
+    code = code.lower()
+    if code in decklist.set_symbols:
+        return True
+    with decklist.set_symbols_lock:
+        if time.monotonic() - sets_loaded_at >= sets_ttl():
+            load_sets()
+    return code in decklist.set_symbols
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve HTML decklists.")
+    parser.add_argument("-b", "--bind", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument("-c", "--cache", help="card cache to resolve through")
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=7,
+        metavar="DAYS",
+        help="refresh cached cards older than this (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    warm()
+
+    cache = Cache(args.cache, args.max_age * 24 * 60 * 60) if args.cache else None
+
+    Handler.resolver = Resolver(cache=cache)
+    server = PooledHTTPServer((args.bind, args.port), Handler, args.workers)
+
+    print(f"Serving on http://{args.bind}:{args.port}/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
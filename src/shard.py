@@ -0,0 +1,138 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+
+def shard_of(path, shards):
+    # Shard by the deck's name rather than its full path, so that every
+    # machine agrees regardless of where it keeps its copy of the decklists.
+    name = os.path.basename(path)
+    digest = hashlib.sha1(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards + 1
+
+
+def parse_shard(spec):
+    try:
+        shard_str, shards_str = spec.split("/")
+        shard, shards = int(shard_str), int(shards_str)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K/N, not {spec!r}") from None
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError(f"shard {shard} is not in 1 to {shards}")
+    return shard, shards
+
+
+def select(paths, shard, shards):
+    return [path for path in paths if shard_of(path, shards) == shard]
+
+
+def manifest_path(shard, shards):
+    return f"shard-{shard}-of-{shards}.json"
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_manifest(shard, shards, paths, outputs):
+    decklists = {}
+    for path in paths:
+        entry = {"input": file_digest(path)}
+        if path in outputs:
+            entry["output"] = outputs[path]
+            entry["digest"] = file_digest(outputs[path])
+        decklists[os.path.basename(path)] = entry
+
+    manifest = {"shard": shard, "shards": shards, "decklists": decklists}
+
+    path = manifest_path(shard, shards)
+    temp_path = f"{path}.{os.getpid()}"
+    with open(temp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def merge(shards, paths):
+    errors = []
+    owners = {}
+    inputs = {}
+    outputs = {}
+
+    for shard in range(1, shards + 1):
+        path = manifest_path(shard, shards)
+        if not os.path.exists(path):
+            errors.append(f"{path} is missing")
+            continue
+
+        with open(path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if (manifest["shard"], manifest["shards"]) != (shard, shards):
+            errors.append(
+                f"{path} is for shard {manifest['shard']}/{manifest['shards']}"
+            )
+            continue
+
+        for name, entry in manifest["decklists"].items():
+            if name in owners:
+                errors.append(f"{name} is in shards {owners[name]} and {shard}")
+                continue
+            owners[name] = shard
+
+            if shard_of(name, shards) != shard:
+                errors.append(f"{name} belongs in shard {shard_of(name, shards)}")
+
+            if "output" not in entry:
+                errors.append(f"{name} failed to build in shard {shard}")
+                continue
+
+            inputs[name] = entry["input"]
+
+            output = entry["output"]
+            if output in outputs:
+                errors.append(
+                    f"{output} is written by both {outputs[output]} and {name}"
+                )
+            outputs[output] = name
+
+            if not os.path.exists(output):
+                errors.append(f"{output} is missing")
+            elif file_digest(output) != entry["digest"]:
+                errors.append(f"{output} has changed since shard {shard} wrote it")
+
+    names = set()
+    for path in paths:
+        name = os.path.basename(path)
+        names.add(name)
+        if name not in owners:
+            errors.append(f"{name} was not built by any shard")
+        elif name in inputs and file_digest(path) != inputs[name]:
+            errors.append(f"{name} has changed since shard {owners[name]} built it")
+
+    for name in owners.keys() - names:
+        errors.append(f"{name} was built by shard {owners[name]} but is not listed")
+
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the shards of a sharded build are complete."
+    )
+    parser.add_argument("shards", type=int, metavar="N")
+    parser.add_argument("decklists", nargs="+", metavar="DECKLIST")
+    args = parser.parse_args()
+
+    errors = merge(args.shards, args.decklists)
+
+    for error in errors:
+        print(f"Error: {error}", file=sys.stderr)
+
+    if errors:
+        print(f"Failed to merge {args.shards} shards", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Merged {args.shards} shards of {len(args.decklists)} decklists")